@@ -72,15 +72,26 @@ class CustomDatasetDataLoader():
         dataset_class = find_dataset_using_name(opt.dataset_mode)
         self.dataset = dataset_class(opt)
         print("dataset [%s] was created" % type(self.dataset).__name__)
+        # In distributed training, every process loads its own shard of the training set.
+        self.sampler = None
+        if torch.distributed.is_available() and torch.distributed.is_initialized() and opt.phase == 'train':
+            self.sampler = torch.utils.data.distributed.DistributedSampler(self.dataset, shuffle=not opt.serial_batches)
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=opt.batch_size,
-            shuffle=not opt.serial_batches,
-            num_workers=int(opt.num_threads))
+            shuffle=not opt.serial_batches and self.sampler is None,
+            sampler=self.sampler,
+            num_workers=int(opt.num_threads),
+            pin_memory=len(opt.gpu_ids) > 0)  # pinned batches can be copied to the GPU asynchronously
 
     def load_data(self):
         return self
 
+    def set_epoch(self, epoch):
+        """Set the epoch of the distributed sampler, so the shards are reshuffled every epoch"""
+        if self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+
     def __len__(self):
         """Return the number of data in the dataset"""
         return min(len(self.dataset), self.opt.max_dataset_size)
@@ -79,4 +79,4 @@ class UNet(nn.Module):
 
         d1 = self.outconv1(up1)  # 256
 
-        return torch.sigmoid(d1)
+        return d1  # logits; the sigmoid is fused into the loss
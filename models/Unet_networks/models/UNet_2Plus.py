@@ -96,6 +96,6 @@ class UNet_2Plus(nn.Module):
         final = (final_1 + final_2 + final_3 + final_4) / 4
 
         if self.is_ds:
-            return torch.sigmoid(final)
+            return final  # logits; the sigmoid is fused into the loss
         else:
-            return torch.sigmoid(final_4)
+            return final_4
@@ -239,7 +239,7 @@ class UNet_3Plus(nn.Module):
             torch.cat((h1_Cat_hd1, hd2_UT_hd1, hd3_UT_hd1, hd4_UT_hd1, hd5_UT_hd1), 1)))) # hd1->320*320*UpChannels
 
         d1 = self.outconv1(hd1)  # d1->320*320*n_classes
-        return torch.sigmoid(d1)
+        return d1  # logits; the sigmoid is fused into the loss
     
 '''
     UNet 3+ with deep supervision
@@ -497,7 +497,7 @@ class UNet_3Plus_DeepSup(nn.Module):
         d2 = self.upscore2(d2) # 128->256
 
         d1 = self.outconv1(hd1) # 256
-        return torch.sigmoid(d1), torch.sigmoid(d2), torch.sigmoid(d3), torch.sigmoid(d4), torch.sigmoid(d5)
+        return d1, d2, d3, d4, d5  # logits; the sigmoid is fused into the loss
     
 '''
     UNet 3+ with deep supervision and class-guided module
@@ -781,4 +781,4 @@ class UNet_3Plus_DeepSup_CGM(nn.Module):
         d4 = self.dotProduct(d4, cls_branch_max)
         d5 = self.dotProduct(d5, cls_branch_max)
 
-        return torch.sigmoid(d1), torch.sigmoid(d2), torch.sigmoid(d3), torch.sigmoid(d4), torch.sigmoid(d5)
+        return d1, d2, d3, d4, d5  # logits; the sigmoid is fused into the loss
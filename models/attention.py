@@ -1,8 +1,7 @@
+import functools
 import torch
 import torch.nn as nn
-import numpy as np
-import cv2
-from util import util
+import torch.nn.functional as F
 
 class SelfAttention(nn.Module):
     """ Self attention Layer"""
@@ -150,24 +149,85 @@ class LinearAttentionClassifier(nn.Module):
 
         return x, c
 
-def calculate_heatmap(data, attention):
-    
+@functools.lru_cache(maxsize=None)
+def jet_colormap(device):
+    """Return the 256 X 3 lookup table of the JET color map on the given device, in BGR channel order like cv2.COLORMAP_JET.
+
+    The table is computed once per device and then reused.
+    """
+    v = torch.arange(256, dtype=torch.float32) / 255.0
+    r = torch.clamp(1.5 - torch.abs(4 * v - 3), 0, 1)
+    g = torch.clamp(1.5 - torch.abs(4 * v - 2), 0, 1)
+    b = torch.clamp(1.5 - torch.abs(4 * v - 1), 0, 1)
+    return (torch.stack((b, g, r), dim=1) * 255.0).to(device)
+
+def apply_colormap(weights, colormap):
+    """Map values in [0, 255] to colors with a 256 X 3 color map lookup table (see <jet_colormap>).
+
+    Parameters:
+        weights (tensor)  -- a B X 1 X H X W tensor with values in [0, 255]
+        colormap (tensor) -- a 256 X 3 lookup table
+
+    Returns a B X 3 X H X W tensor with the colors of the lookup table.
+    """
+    # Quantize to 256 levels (as cv2 does for uint8 images) and look the colors up in the table.
+    idx = torch.round(weights[:, 0]).long()
+    return colormap[idx].permute(0, 3, 1, 2)
+
+def colormap_heatmap(data, attention, colormap):
+    """Calculate heat maps of attention weights over the input images with the given color map lookup table.
+    This function is scriptable; see <calculate_heatmap> for the parameters and return values.
+    """
     # post-process attention weights
     weights = torch.abs(attention)
-    b, c, h, w = weights.size()
-    weights = torch.sum(weights, dim=1).view(b, 1, h, w)
-
-    # Convert tensors to numpy images
-    img = util.tensor2im(data)
-    weights = util.tensor2im(weights)
+    weights = torch.sum(weights.float(), dim=1, keepdim=True)  # sum in float32, the features may be float16
 
-    # resize and convert to image 
-    weights = cv2.resize(weights, (img.shape[0], img.shape[1]))
+    # Scale to the image range [0, 255] and wrap around to 8 bits, like tensor2im followed by astype(uint8) did,
+    # then resize to the input image size.
+    weights = torch.remainder(torch.floor((weights + 1) / 2.0 * 255.0), 256)
+    weights = F.interpolate(weights, size=[data.size(2), data.size(3)], mode='bilinear', align_corners=False)
     #weights /= weights.max()
     #weights *= 255
-    #weights =  255 - weights.astype('uint8')
+    #weights =  255 - weights
+
+    # generate heat maps
+    weights = apply_colormap(weights, colormap)
+    img = (data.float() + 1) / 2.0 * 255.0
+    if img.size(1) == 1:  # grayscale to RGB
+        img = img.repeat(1, 3, 1, 1)
+    heatmap = 0.3 * weights + 0.7 * img
+    heatmap = heatmap / 255.0 * 2 - 1
+    return heatmap, weights
+
+def calculate_heatmap(data, attention):
+    """Calculate heat maps of attention weights over the input images, keeping all computations on the input device.
+
+    Parameters:
+        data (tensor)      -- B X C X H X W input images in [-1, 1]
+        attention (tensor) -- B X C' X H' X W' attention weights (or feature maps)
 
-    # generate heat maps 
-    weights = cv2.applyColorMap(weights, cv2.COLORMAP_JET)
-    heatmap = cv2.addWeighted(weights, 0.3, img, 0.7, 0)
-    return heatmap, weights
\ No newline at end of file
+    Returns:
+        heatmap -- B X 3 X H X W heat maps blended over the input images, in [-1, 1]
+        weights -- B X 3 X H X W attention weights, color mapped with the JET color map, in [0, 255]
+    """
+    return colormap_heatmap(data, attention, jet_colormap(data.device))
+
+class AuxiliaryPipeline(nn.Module):
+    """Compute the heat maps and color mapped feature maps of images with an auxiliary network, as a single module.
+
+    The module can be scripted with torch.jit.script, so the whole auxiliary preprocessing runs as one graph.
+    """
+    def __init__(self, net, half=False):
+        """
+        Parameters:
+            net (network) -- the (truncated) auxiliary network, which returns the feature maps of its input
+            half (bool)   -- whether the network runs in float16; its input is cast accordingly
+        """
+        super(AuxiliaryPipeline, self).__init__()
+        self.net = net
+        self.half_input = half
+        self.register_buffer('colormap', jet_colormap(torch.device('cpu')).clone())
+
+    def forward(self, x):
+        features = self.net(x.half() if self.half_input else x)
+        return colormap_heatmap(x, features, self.colormap)
@@ -127,16 +127,6 @@ class AttentionCycleGANModel(BaseModel):
         self.heatmap_A, self.att_A = calculate_heatmap(self.real_A, self.att_A)
         self.heatmap_B, self.att_B = calculate_heatmap(self.real_B, self.att_B)
 
-        self.att_A = torch.from_numpy(self.att_A)
-        self.att_B = torch.from_numpy(self.att_B)
-
-        self.att_A = self.att_A.permute(2, 0, 1).unsqueeze(0)
-        self.att_B = self.att_B.permute(2, 0, 1).unsqueeze(0)
-        
-        # Send attention maps to device
-        self.att_A = self.att_A.to(self.device)
-        self.att_B = self.att_B.to(self.device)
-
     def forward(self):
         """Run forward pass; called by both functions <optimize_parameters> and <test>.
         Add the attention map of input A for the first direction (AtoB) and add the attention map of B for the reversed direction.
@@ -34,6 +34,8 @@ class BaseModel(ABC):
         self.isTrain = opt.isTrain
         self.device = torch.device('cuda:{}'.format(self.gpu_ids[0])) if self.gpu_ids else torch.device('cpu')  # get device name: CPU or GPU
         self.save_dir = os.path.join(opt.checkpoints_dir, opt.name)  # save all the checkpoints to save_dir
+        # In distributed training, only the first process saves the networks.
+        self.is_main_process = not (torch.distributed.is_available() and torch.distributed.is_initialized()) or torch.distributed.get_rank() == 0
         if opt.preprocess != 'scale_width':  # with [scale_width], input images might have different sizes, which hurts the performance of cudnn.benchmark.
             torch.backends.cudnn.benchmark = True
         self.loss_names = []
@@ -88,6 +90,14 @@ class BaseModel(ABC):
             self.load_networks(load_suffix)
         self.print_networks(opt)
         self.save_model()
+        if opt.compile:
+            self.compile_networks()
+
+    def compile_networks(self):
+        """Compile the networks with torch.compile; called at the end of <setup>, after the networks are loaded and saved"""
+        for name in self.model_names:
+            if isinstance(name, str):
+                networks.compile_net(getattr(self, 'net' + name))
 
     def train(self):
         """Make models train mode during train time"""
@@ -164,6 +174,8 @@ class BaseModel(ABC):
         Parameters:
             epoch (int) -- current epoch; used in the file name '%s_net_%s.pth' % (epoch, name)
         """
+        if not self.is_main_process:
+            return
         for name in self.model_names:
             if isinstance(name, str):
                 save_filename = '%s_net_%s.pth' % (epoch, name)
@@ -201,7 +213,7 @@ class BaseModel(ABC):
                 load_filename = '%s_net_%s.pth' % (epoch, name)
                 load_path = os.path.join(self.save_dir, load_filename)
                 net = getattr(self, 'net' + name)
-                if isinstance(net, torch.nn.DataParallel):
+                if isinstance(net, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
                     net = net.module
                 print('loading the model from %s' % load_path)
                 # if you are using PyTorch newer than 0.4 (e.g., built from
@@ -250,6 +262,8 @@ class BaseModel(ABC):
     def save_model(self):
         """ Save model architecture to the disk
         """
+        if not self.is_main_process:
+            return
         for name in self.model_names:
             if isinstance(name, str):
                 save_filename = '%s_model.pth' % (name)
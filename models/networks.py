@@ -116,6 +116,28 @@ def init_net(net, init_type='normal', init_gain=0.02, gpu_ids=[]):
     return net
 
 
+def compile_net(net, mode='default'):
+    """Compile a network in place with torch.compile.
+
+    Parameters:
+        net (network) -- the network to be compiled
+        mode (str)    -- the torch.compile mode: default | reduce-overhead | max-autotune
+
+    The wrapped module of a DataParallel network is compiled, and the compilation is done in place,
+    so the network's state_dict keys (and therefore saving and loading checkpoints) are not affected.
+    The modes reduce-overhead and max-autotune replay CUDA graphs, which overwrite their outputs on every call;
+    do not use them for networks whose outputs are kept across iterations (e.g. in an ImagePool).
+    """
+    if isinstance(net, torch.nn.DataParallel):
+        # DataParallel runs replicas of the wrapped module, which do not share its compiled forward.
+        if len(net.device_ids) > 1:
+            raise NotImplementedError('--compile supports a single GPU, got gpu_ids %s' % net.device_ids)
+        net.module.compile(mode=mode)
+    else:
+        net.compile(mode=mode)
+    return net
+
+
 def define_G(input_nc, output_nc, ngf, netG, norm='batch', use_dropout=False, init_type='normal', init_gain=0.02, gpu_ids=[]):
     """Create a generator
 
@@ -1,10 +1,11 @@
 import torch
 import itertools
+from collections import OrderedDict
 from util.image_pool import ImagePool
 from .base_model import BaseModel
 from . import networks
 from torch.nn.functional import interpolate
-from .attention import calculate_heatmap
+from .attention import AuxiliaryPipeline
 
 class PerceptualCycleGANModel(BaseModel):
     """
@@ -40,6 +41,8 @@ class PerceptualCycleGANModel(BaseModel):
         parser.set_defaults(no_dropout=True)  # default CycleGAN did not use dropout
         parser.add_argument('--aux_model_path', type=str, default=None, help='The path to the pretrained auxiliary network to load')
         parser.add_argument('--eval_net_path', type=str, default=None, help='evaluate gan model using a classifier, contains the path to the evaluation model.')
+        parser.add_argument('--aux_half', action='store_true', help='run the frozen auxiliary and evaluation networks in float16 on GPU. This changes the auxiliary inputs of the generators and the validation accuracy, so networks trained without it should keep it off')
+        parser.add_argument('--aux_cache_size', type=int, default=0, help='the number of images whose auxiliary feature maps are cached on the device, keyed by image path. 0 disables the cache. Requires deterministic preprocessing (--no_flip and no random crop)')
         if is_train:
             parser.add_argument('--lambda_A', type=float, default=10.0, help='weight for cycle loss (A -> B -> A)')
             parser.add_argument('--lambda_B', type=float, default=10.0, help='weight for cycle loss (B -> A -> B)')
@@ -48,14 +51,6 @@ class PerceptualCycleGANModel(BaseModel):
             parser.add_argument('--use_val', action='store_true', help='Use the specified evaluation network during evaluation')
         return parser
 
-    def get_activation(self, name):
-        """
-        Define a hook to get intermediate activation results
-        """
-        def hook(model, input, output):
-            self.activation[name] = output.detach()
-        return hook
-
     def __init__(self, opt):
         """Initialize the CycleGAN class.
 
@@ -83,13 +78,22 @@ class PerceptualCycleGANModel(BaseModel):
         # Load the auxiliary model, and freeze it's parameters to prevent it from learning.
         self.aux_net = self.load_model_by_path(opt.aux_model_path, name='Classification')
         self.set_requires_grad([self.aux_net], False)
+        self.aux_net.eval()
         
-        # Initiate a dictionary to hold activation results from the hook, and set the hook.
-        self.activation = {}
-        self.aux_net.layer4.register_forward_hook(self.get_activation('layer4'))
+        # Truncate the (ResNet) auxiliary network after layer4, so its forward returns the feature maps directly and skips the unused avgpool and fc layers.
+        aux_layer_names = ['conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3', 'layer4']
+        self.aux_trunk = torch.nn.Sequential(OrderedDict([(name, getattr(self.aux_net, name)) for name in aux_layer_names])).eval()
 
         # Set the aux num of channels
         self.aux_nc = 3
+
+        # The auxiliary feature maps of an image only depend on its path if the preprocessing is deterministic.
+        self.aux_cache = None
+        if opt.aux_cache_size > 0:
+            if opt.no_flip and 'crop' not in opt.preprocess:
+                self.aux_cache = OrderedDict()
+            else:
+                print('The auxiliary feature cache requires --no_flip and a preprocessing without random crops, the cache is disabled')
         
         # Load the evaluation network, if it exists, and freeze it's parameters to prevent it from learning.
         if opt.use_val:
@@ -100,6 +104,7 @@ class PerceptualCycleGANModel(BaseModel):
             
             self.eval_net = self.load_model_by_path(opt.eval_net_path, name='Classification')
             self.set_requires_grad([self.eval_net], False)
+            self.eval_net.eval()
 
         # define networks (both Generators and discriminators)
         # The naming is different from those used in the paper.
@@ -109,12 +114,40 @@ class PerceptualCycleGANModel(BaseModel):
         self.netG_B = networks.define_G(opt.output_nc + self.aux_nc, opt.input_nc, opt.ngf, opt.netG, opt.norm,
                                         not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids)
 
+        # Inputs that go through the same network are batched together, unless batch normalization would mix their statistics.
+        self.fuse_batches = opt.norm != 'batch'
+        # The identity mappings are computed together with the cycles, while the generators are in train mode.
+        self.use_idt = self.isTrain and opt.lambda_identity > 0.0
+
+        # The A->B->A and B->A->B cycles are independent, so on GPU each one runs on its own CUDA stream.
+        if len(self.gpu_ids) > 0:
+            self.stream_A = torch.cuda.Stream(device=self.device)
+            self.stream_B = torch.cuda.Stream(device=self.device)
+
         if self.isTrain:  # define discriminators
             self.netD_A = networks.define_D(opt.output_nc, opt.ndf, opt.netD,
                                             opt.n_layers_D, opt.norm, opt.init_type, opt.init_gain, self.gpu_ids)
             self.netD_B = networks.define_D(opt.input_nc, opt.ndf, opt.netD,
                                             opt.n_layers_D, opt.norm, opt.init_type, opt.init_gain, self.gpu_ids)
 
+        # Use the channels_last memory format, so cuDNN can select NHWC convolution kernels.
+        self.aux_net.to(memory_format=torch.channels_last)
+        for name in self.model_names:
+            getattr(self, 'net' + name).to(memory_format=torch.channels_last)
+
+        # With --aux_half, the frozen auxiliary and evaluation networks run in float16 on GPU to halve their memory traffic.
+        # The heat maps quantize the sum of the features, so float16 changes them; float32 stays the default.
+        self.aux_half = len(self.gpu_ids) > 0 and opt.aux_half
+        if self.aux_half:
+            self.aux_net.half()
+            if opt.use_val:
+                self.eval_net.half()
+
+        # Run the auxiliary network and the heat map post-processing as a single module, scripted unless it is compiled with --compile.
+        self.aux_pipeline = AuxiliaryPipeline(self.aux_trunk, half=self.aux_half).to(self.device).eval()
+        if not opt.compile:
+            self.aux_pipeline = torch.jit.script(self.aux_pipeline)
+
         if self.isTrain:
             if opt.lambda_identity > 0.0:  # only works when input and output images have the same number of channels
                 assert(opt.input_nc == opt.output_nc)
@@ -129,6 +162,13 @@ class PerceptualCycleGANModel(BaseModel):
             self.optimizer_D = torch.optim.Adam(itertools.chain(self.netD_A.parameters(), self.netD_B.parameters()), lr=opt.lr, betas=(opt.beta1, 0.999))
             self.optimizers.append(self.optimizer_G)
             self.optimizers.append(self.optimizer_D)
+            # gradient scaler for mixed precision training; a no-op unless --amp is set.
+            self.scaler = torch.cuda.amp.GradScaler(enabled=opt.amp)
+
+    def compile_networks(self):
+        """Compile the generators, discriminators and the auxiliary pipeline with torch.compile"""
+        BaseModel.compile_networks(self)
+        networks.compile_net(self.aux_pipeline)
 
     def set_input(self, input):
         """Unpack input data from the dataloader and perform necessary pre-processing steps.
@@ -139,40 +179,119 @@ class PerceptualCycleGANModel(BaseModel):
         The option 'direction' can be used to swap domain A and domain B.
         """
         AtoB = self.opt.direction == 'AtoB'
-        self.real_A = input['A' if AtoB else 'B'].to(self.device)
-        self.real_B = input['B' if AtoB else 'A'].to(self.device)
+        self.real_A = input['A' if AtoB else 'B'].to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+        self.real_B = input['B' if AtoB else 'A'].to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
         self.image_paths = input['A_paths' if AtoB else 'B_paths']
 
-        # Calculate auxiliary feature maps
-        self.aux_A_out = self.aux_net(self.real_A)
-        self.aux_A = self.activation['layer4']
+        # Calculate auxiliary feature maps and heat maps for both domains together.
+        paths = list(input['A_paths' if AtoB else 'B_paths']) + list(input['B_paths' if AtoB else 'A_paths'])
+        heatmap, aux = self.calculate_aux(torch.cat((self.real_A, self.real_B), dim=0), paths)
+        self.heatmap_A, self.heatmap_B = heatmap[:self.real_A.size(0)], heatmap[self.real_A.size(0):]
+        self.aux_A, self.aux_B = aux[:self.real_A.size(0)], aux[self.real_A.size(0):]
 
-        self.aux_B_out = self.aux_net(self.real_B)
-        self.aux_B = self.activation['layer4']
+    def calculate_aux(self, images, paths):
+        """Calculate the heat maps and post-processed auxiliary feature maps of a batch of images.
 
-        # post-process auxiliary feature maps
-        self.heatmap_A, self.aux_A = calculate_heatmap(self.real_A, self.aux_A)
-        self.heatmap_B, self.aux_B = calculate_heatmap(self.real_B, self.aux_B)
+        Parameters:
+            images (tensor) -- a batch of input images
+            paths (list)    -- the image path of each image in the batch
 
-        self.aux_A = torch.from_numpy(self.aux_A)
-        self.aux_B = torch.from_numpy(self.aux_B)
+        When the auxiliary cache is enabled, the results of previously seen images are reused,
+        and the least recently used images are evicted once the cache exceeds <aux_cache_size>.
+        """
+        if self.aux_cache is None:
+            return self.compute_aux(images)
+
+        missing = [i for i, path in enumerate(paths) if path not in self.aux_cache]
+        if len(missing) > 0:
+            heatmap, aux = self.compute_aux(images[missing])
+            # Clone the entries, so a cached entry does not keep the memory of the whole batch alive.
+            for j, i in enumerate(missing):
+                self.aux_cache[paths[i]] = (heatmap[j].clone(), aux[j].clone())
+
+        results = []
+        for path in paths:
+            self.aux_cache.move_to_end(path)
+            results.append(self.aux_cache[path])
+        while len(self.aux_cache) > self.opt.aux_cache_size:
+            self.aux_cache.popitem(last=False)
+
+        heatmap = torch.stack([result[0] for result in results], dim=0)
+        aux = torch.stack([result[1] for result in results], dim=0)
+        return heatmap, aux
+
+    def compute_aux(self, images):
+        """Run the auxiliary network on a batch of images and post-process its feature maps into heat maps."""
+        with torch.no_grad():
+            return self.aux_pipeline(images)
+
+    def cat_input(self, *pairs):
+        """Concatenate images with their auxiliary feature maps into a generator input.
 
-        self.aux_A = self.aux_A.permute(2, 0, 1).unsqueeze(0)
-        self.aux_B = self.aux_B.permute(2, 0, 1).unsqueeze(0)
-        
-        # Send feature maps to device
-        self.aux_A = self.aux_A.to(self.device)
-        self.aux_B = self.aux_B.to(self.device)
+        Parameters:
+            pairs (tuples) -- (image, aux) pairs, concatenated along the channel dimension and stacked along the batch dimension
+        """
+        inputs = [torch.cat((image, aux), dim=1) for image, aux in pairs]
+        return inputs[0] if len(inputs) == 1 else torch.cat(inputs, dim=0)
+
+    def forward_A(self, compute_idt):
+        """Run the forward cycle A -> B -> A, and the identity mapping G_A(B) if <compute_idt> is set."""
+        idt_A = None
+        if compute_idt and self.fuse_batches:
+            # G_A(A, aux_A) and G_A(B, aux_B) in a single batch
+            output = self.netG_A(self.cat_input((self.real_A, self.aux_A), (self.real_B, self.aux_B)))
+            fake_B, idt_A = output[:self.real_A.size(0)], output[self.real_A.size(0):]
+        else:
+            fake_B = self.netG_A(self.cat_input((self.real_A, self.aux_A)))        # G_A(A,aux_A)
+            if compute_idt:
+                idt_A = self.netG_A(self.cat_input((self.real_B, self.aux_B)))      # G_A(B, aux_B)
+        rec_A = self.netG_B(self.cat_input((fake_B, self.aux_A)))                   # G_B(G_A(A, aux_A), aux_A)
+        return fake_B, rec_A, idt_A
+
+    def forward_B(self, compute_idt):
+        """Run the backward cycle B -> A -> B, and the identity mapping G_B(A) if <compute_idt> is set."""
+        idt_B = None
+        if compute_idt and self.fuse_batches:
+            # G_B(B, aux_B) and G_B(A, aux_A) in a single batch
+            output = self.netG_B(self.cat_input((self.real_B, self.aux_B), (self.real_A, self.aux_A)))
+            fake_A, idt_B = output[:self.real_B.size(0)], output[self.real_B.size(0):]
+        else:
+            fake_A = self.netG_B(self.cat_input((self.real_B, self.aux_B)))        # G_B(B, aux_B)
+            if compute_idt:
+                idt_B = self.netG_B(self.cat_input((self.real_A, self.aux_A)))      # G_B(A, aux_A)
+        rec_B = self.netG_A(self.cat_input((fake_A, self.aux_B)))                   # G_A(G_B(B, aux_B), aux_B)
+        return fake_A, rec_B, idt_B
 
     def forward(self):
         """Run forward pass; called by both functions <optimize_parameters> and <test>.
         Add the auxiliary feature map of input A for the first direction (AtoB) and add the auxiliary feature map of B for the reversed direction.
+        On GPU, the two independent cycles are launched on separate CUDA streams so their kernels can overlap.
         """
-
-        self.fake_B = self.netG_A(torch.cat((self.real_A, self.aux_A), dim=1))  # G_A(A,aux_A)
-        self.rec_A = self.netG_B(torch.cat((self.fake_B, self.aux_A), dim=1))   # G_B(G_A(A, aux_A), aux_A)
-        self.fake_A = self.netG_B(torch.cat((self.real_B, self.aux_B), dim=1))  # G_B(B, aux_B)
-        self.rec_B = self.netG_A(torch.cat((self.fake_A, self.aux_B), dim=1))   # G_A(G_B(B, aux_B), aux_B)
+        # The identity mappings are only needed for the identity loss, not in eval mode (e.g. in <model_evaluation>).
+        compute_idt = self.use_idt and self.netG_A.training
+        if len(self.gpu_ids) == 0:
+            self.fake_B, self.rec_A, self.idt_A = self.forward_A(compute_idt)
+            self.fake_A, self.rec_B, self.idt_B = self.forward_B(compute_idt)
+            return
+
+        current_stream = torch.cuda.current_stream(self.device)
+        # The side streams must wait for the inputs produced on the current stream, which must stay allocated until they are read.
+        self.stream_A.wait_stream(current_stream)
+        self.stream_B.wait_stream(current_stream)
+        self.real_A.record_stream(self.stream_A)
+        self.aux_A.record_stream(self.stream_A)
+        self.real_B.record_stream(self.stream_B)
+        self.aux_B.record_stream(self.stream_B)
+        with torch.cuda.stream(self.stream_A):
+            self.fake_B, self.rec_A, self.idt_A = self.forward_A(compute_idt)
+        with torch.cuda.stream(self.stream_B):
+            self.fake_A, self.rec_B, self.idt_B = self.forward_B(compute_idt)
+        # Join back before the outputs are used on the current stream, and keep their memory alive for it.
+        current_stream.wait_stream(self.stream_A)
+        current_stream.wait_stream(self.stream_B)
+        for output in (self.fake_B, self.rec_A, self.idt_A, self.fake_A, self.rec_B, self.idt_B):
+            if output is not None:
+                output.record_stream(current_stream)
 
     def backward_D_basic(self, netD, real, fake):
         """Calculate GAN loss for the discriminator
@@ -185,15 +304,22 @@ class PerceptualCycleGANModel(BaseModel):
         Return the discriminator loss.
         We also call loss_D.backward() to calculate the gradients.
         """
-        # Real
-        pred_real = netD(real)
-        loss_D_real = self.criterionGAN(pred_real, True)
-        # Fake
-        pred_fake = netD(fake.detach())
-        loss_D_fake = self.criterionGAN(pred_fake, False)
-        # Combined loss and calculate gradients
-        loss_D = (loss_D_real + loss_D_fake) * 0.5
-        loss_D.backward()
+        with torch.cuda.amp.autocast(enabled=self.opt.amp):
+            if self.fuse_batches:
+                # Real and fake in a single batch
+                pred = netD(torch.cat((real, fake.detach()), dim=0))
+                pred_real, pred_fake = pred[:real.size(0)], pred[real.size(0):]
+            else:
+                pred_real = netD(real)
+                pred_fake = netD(fake.detach())
+            # Real
+            loss_D_real = self.criterionGAN(pred_real, True)
+            # Fake
+            loss_D_fake = self.criterionGAN(pred_fake, False)
+            # Combined loss
+            loss_D = (loss_D_real + loss_D_fake) * 0.5
+        # calculate (scaled) gradients
+        self.scaler.scale(loss_D).backward()
         return loss_D
 
     def backward_D_A(self):
@@ -211,45 +337,50 @@ class PerceptualCycleGANModel(BaseModel):
         lambda_idt = self.opt.lambda_identity
         lambda_A = self.opt.lambda_A
         lambda_B = self.opt.lambda_B
-        # Identity loss
-        if lambda_idt > 0:
-            # G_A should be identity if real_B is fed: ||G_A(B) - B||
-            self.idt_A = self.netG_A(torch.cat((self.real_B, self.aux_B), dim=1))
-            self.loss_idt_A = self.criterionIdt(self.idt_A, self.real_B) * lambda_B * lambda_idt
-            # G_B should be identity if real_A is fed: ||G_B(A) - A||
-            self.idt_B = self.netG_B(torch.cat((self.real_A, self.aux_A), dim=1))
-            self.loss_idt_B = self.criterionIdt(self.idt_B, self.real_A) * lambda_A * lambda_idt
-        else:
-            self.loss_idt_A = 0
-            self.loss_idt_B = 0
-
-        # GAN loss D_A(G_A(A))
-        self.loss_G_A = self.criterionGAN(self.netD_A(self.fake_B), True)
-        # GAN loss D_B(G_B(B))
-        self.loss_G_B = self.criterionGAN(self.netD_B(self.fake_A), True)
-        # Forward cycle loss || G_B(G_A(A)) - A||
-        self.loss_cycle_A = self.criterionCycle(self.rec_A, self.real_A) * lambda_A
-        # Backward cycle loss || G_A(G_B(B)) - B||
-        self.loss_cycle_B = self.criterionCycle(self.rec_B, self.real_B) * lambda_B
-        # combined loss and calculate gradients
-        self.loss_G = self.loss_G_A + self.loss_G_B + self.loss_cycle_A + self.loss_cycle_B + self.loss_idt_A + self.loss_idt_B
-        self.loss_G.backward()
+        with torch.cuda.amp.autocast(enabled=self.opt.amp):
+            # Identity loss; idt_A and idt_B were computed in <forward>
+            if lambda_idt > 0:
+                # G_A should be identity if real_B is fed: ||G_A(B) - B||
+                self.loss_idt_A = self.criterionIdt(self.idt_A, self.real_B) * lambda_B * lambda_idt
+                # G_B should be identity if real_A is fed: ||G_B(A) - A||
+                self.loss_idt_B = self.criterionIdt(self.idt_B, self.real_A) * lambda_A * lambda_idt
+            else:
+                self.loss_idt_A = 0
+                self.loss_idt_B = 0
+
+            # GAN loss D_A(G_A(A))
+            self.loss_G_A = self.criterionGAN(self.netD_A(self.fake_B), True)
+            # GAN loss D_B(G_B(B))
+            self.loss_G_B = self.criterionGAN(self.netD_B(self.fake_A), True)
+            # Forward cycle loss || G_B(G_A(A)) - A||
+            self.loss_cycle_A = self.criterionCycle(self.rec_A, self.real_A) * lambda_A
+            # Backward cycle loss || G_A(G_B(B)) - B||
+            self.loss_cycle_B = self.criterionCycle(self.rec_B, self.real_B) * lambda_B
+            # combined loss, summed in a single reduction
+            losses = [self.loss_G_A, self.loss_G_B, self.loss_cycle_A, self.loss_cycle_B]
+            if lambda_idt > 0:
+                losses += [self.loss_idt_A, self.loss_idt_B]
+            self.loss_G = torch.stack(losses).sum()
+        # calculate (scaled) gradients
+        self.scaler.scale(self.loss_G).backward()
 
     def optimize_parameters(self):
         """Calculate losses, gradients, and update network weights; called in every training iteration"""
         # forward
-        self.forward()      # compute fake images and reconstruction images.
+        with torch.cuda.amp.autocast(enabled=self.opt.amp):
+            self.forward()      # compute fake images and reconstruction images.
         # G_A and G_B
         self.set_requires_grad([self.netD_A, self.netD_B], False)  # Ds require no gradients when optimizing Gs
-        self.optimizer_G.zero_grad()  # set G_A and G_B's gradients to zero
+        self.optimizer_G.zero_grad(set_to_none=True)  # set G_A and G_B's gradients to None
         self.backward_G()             # calculate gradients for G_A and G_B
-        self.optimizer_G.step()       # update G_A and G_B's weights
+        self.scaler.step(self.optimizer_G)  # update G_A and G_B's weights
         # D_A and D_B
         self.set_requires_grad([self.netD_A, self.netD_B], True)
-        self.optimizer_D.zero_grad()   # set D_A and D_B's gradients to zero
+        self.optimizer_D.zero_grad(set_to_none=True)   # set D_A and D_B's gradients to None
         self.backward_D_A()      # calculate gradients for D_A
         self.backward_D_B()      # calculate graidents for D_B
-        self.optimizer_D.step()  # update D_A and D_B's weights
+        self.scaler.step(self.optimizer_D)  # update D_A and D_B's weights
+        self.scaler.update()     # update the loss scale once per iteration
 
     def model_evaluation(self):
             """Generate synthetic images, and evaluate their accuracy using the pre-trained evalualtion network"""
@@ -262,7 +393,7 @@ class PerceptualCycleGANModel(BaseModel):
 
             # forward the data to the evaluation network
             with torch.no_grad():
-                preds = self.eval_net(images)
+                preds = self.eval_net(images.half() if self.aux_half else images)
 
             # calculate predictions
             _, preds = torch.max(preds, 1)
@@ -37,6 +37,7 @@ class UnetModel(BaseModel):
         if is_train:
             parser.add_argument('--unet_type', type=str, default='unet', help='Specify the type of Unet to use [unet | unet_2plus | unet_3plus | unet_3plus_deepsup | unet_3plus_deepsup_cgm]')
             parser.add_argument('--loss_type', type=str, default='bce', help='the type of loss objective. [bce | iou]. Default loss is the binary cross-entropy loss function.')
+            parser.add_argument('--cuda_graph', action='store_true', help='capture the training step into a CUDA graph and replay it. Used on GPU with the bce and iou losses, without --amp and --compile. With torchrun, set TORCH_NCCL_ASYNC_ERROR_HANDLING=0.')
 
         return parser
 
@@ -60,13 +61,21 @@ class UnetModel(BaseModel):
         # Update input size
         opt.load_size = 512
         opt.crop_size = 320
+
+        # Use the channels_last memory format, so cuDNN can select NHWC convolution kernels.
+        # This must happen before DistributedDataParallel lays out its gradient buckets from the parameter strides.
+        model.to(memory_format=torch.channels_last)
         
-        # Initialize network for training.
+        # Initialize network for training. On GPU, the network is trained with DistributedDataParallel when launched with torchrun
+        # (one process per GPU), and with DataParallel otherwise.
         if len(self.gpu_ids) > 0:
             assert(torch.cuda.is_available())
             model.to(self.gpu_ids[0])
-            net = torch.nn.DataParallel(model, self.gpu_ids)  # multi-GPUs
-        return net
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)  # share the batch norm statistics across processes
+                return torch.nn.parallel.DistributedDataParallel(model, device_ids=[self.gpu_ids[0]])
+            return torch.nn.DataParallel(model, self.gpu_ids)
+        return model
 
     def __init__(self, opt):
         """Initialize this model class.
@@ -92,7 +101,7 @@ class UnetModel(BaseModel):
         if self.isTrain:  # only defined during training time
             
             # Define loss criterion and select the chosen loss for training.
-            self.criterionBCE = torch.nn.BCELoss(reduction='mean')
+            self.criterionBCE = torch.nn.BCEWithLogitsLoss(reduction='mean')  # the networks output logits
             self.criterionIOU = iouLoss.IOU(size_average=True)
             self.criterionMSSSIM = msssimLoss.MSSSIM(size_average=True)
 
@@ -103,6 +112,15 @@ class UnetModel(BaseModel):
             self.optimizer = torch.optim.SGD(self.netUnet.parameters(), lr=0.001, momentum=0.9)
 
             self.optimizers = [self.optimizer]
+            # gradient scaler for mixed precision training; a no-op unless --amp is set.
+            self.scaler = torch.cuda.amp.GradScaler(enabled=opt.amp)
+
+            # The training step can be captured into a CUDA graph, if all its operations are capturable; see <optimize_parameters>.
+            self.use_cuda_graph = opt.cuda_graph and len(self.gpu_ids) > 0 and not opt.amp and not opt.compile and opt.loss_type in ('bce', 'iou')
+            if opt.cuda_graph and not self.use_cuda_graph:
+                print('CUDA graph capture requires a GPU, the bce or iou loss, and no --amp or --compile; training without it')
+            self.graph = None
+            self.graph_warmup_iters = 11  # DistributedDataParallel requires at least 11 warmup iterations before capture
 
         # Our program will automatically call <model.setup> to define schedulers, load networks, and print networks
 
@@ -112,49 +130,127 @@ class UnetModel(BaseModel):
         Parameters:
             input: a dictionary that contains the data itself and its metadata information.
         """
-        self.img = input['img'].to(self.device)  # get image data
-        self.seg = input['seg'].to(self.device)  # get segmentation data
+        self.img = input['img'].to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)  # get image data
+        self.seg = input['seg'].to(self.device, non_blocking=True)  # get segmentation data
         self.seg = (self.seg + 1) / 2
         self.image_paths = input['img_paths']    # get image paths
 
     def forward(self):
         """Run forward pass. This will be called by both functions <optimize_parameters> and <test>."""
-        self.output = self.netUnet(self.img)  # generate output segmentation given the input image
+        output = self.netUnet(self.img)  # generate output segmentation logits given the input image
+        # The deep supervision variants return the logits of every decoder stage, d1 is the final prediction.
+        self.outputs = output if isinstance(output, tuple) else (output,)
+        self.output = self.outputs[0]
 
     def backward(self):
         """Calculate losses, gradients, and update network weights; called in every training iteration"""
         # caculate the intermediate results if necessary; here self.output has been computed during function <forward>
         # calculate loss given the input and intermediate results
 
-        self.train_loss = self.train_criterion(self.output, self.seg)
-        self.train_loss.backward()       # calculate gradients of the network w.r.t. the chosen loss criterion.
+        # The loss is calculated in float32, outside of autocast. The BCE loss takes the logits, the other losses take probabilities.
+        # With deep supervision, the losses of all the decoder stages are summed.
+        losses = []
+        for output in self.outputs:
+            output = output.float()
+            if self.opt.loss_type != 'bce':
+                output = torch.sigmoid(output)
+            losses.append(self.train_criterion(output, self.seg))
+        self.train_loss = torch.stack(losses).sum()
+        self.scaler.scale(self.train_loss).backward()   # calculate (scaled) gradients of the network w.r.t. the chosen loss criterion.
         
-    def optimize_parameters(self):
-        """Update network weights; it will be called in every training iteration."""
-        self.forward()               # first call forward to calculate intermediate results
-        self.optimizer.zero_grad()   # clear network G's existing gradients
+    def training_step(self):
+        """Run a single training step eagerly."""
+        with torch.cuda.amp.autocast(enabled=self.opt.amp):
+            self.forward()           # first call forward to calculate intermediate results
+        self.optimizer.zero_grad(set_to_none=True)   # clear network G's existing gradients
         self.backward()              # calculate gradients for network G
-        self.optimizer.step()        # update gradients for network G
+        self.scaler.step(self.optimizer)  # update gradients for network G
+        self.scaler.update()         # update the loss scale
+
+    def optimize_parameters(self):
+        """Update network weights; it will be called in every training iteration.
+
+        With --cuda_graph, the first iterations are run eagerly on a side stream to warm up, then the training step
+        is captured into a CUDA graph with static input tensors, and every following iteration copies its batch into
+        the static inputs and replays the graph. A batch of a different size (e.g. the last batch of an epoch) is
+        run eagerly, and the graph is captured again on the next iteration.
+        """
+        if not self.use_cuda_graph:
+            self.training_step()
+            return
+
+        if self.graph is not None and self.img.shape == self.static_img.shape and self.seg.shape == self.static_seg.shape:
+            self.replay_training_step()
+        elif self.graph_warmup_iters > 0:
+            self.graph_warmup_iters -= 1
+            side_stream = torch.cuda.Stream(device=self.device)
+            side_stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(side_stream):
+                self.training_step()
+            torch.cuda.current_stream(self.device).wait_stream(side_stream)
+        elif self.graph is None:
+            self.capture_training_step()
+            self.replay_training_step()  # capturing does not run the step
+        else:
+            self.graph = None
+            self.training_step()
+
+    def capture_training_step(self):
+        """Capture the forward, backward and optimizer step into a CUDA graph, with static copies of the current batch as inputs."""
+        img, seg = self.img, self.seg
+        self.img = self.static_img = img.clone()
+        self.seg = self.static_seg = seg.clone()
+        self.graph = torch.cuda.CUDAGraph()
+        self.optimizer.zero_grad(set_to_none=True)  # the captured backward allocates the gradients from the graph's memory pool
+        with torch.cuda.graph(self.graph):
+            self.forward()
+            self.backward()
+            self.optimizer.step()
+        self.img, self.seg = img, seg
+
+    def replay_training_step(self):
+        """Copy the current batch into the static inputs and replay the captured training step."""
+        self.static_img.copy_(self.img)
+        self.static_seg.copy_(self.seg)
+        self.graph.replay()  # self.output and self.train_loss are the static outputs of the graph
+
+    def update_learning_rate(self):
+        """Update learning rates; called at the end of every epoch.
+        The learning rate is baked into a captured optimizer step, so the training step is captured again afterwards.
+        """
+        BaseModel.update_learning_rate(self)
+        self.graph = None
+
+    def save_networks(self, epoch):
+        """Save all the networks to the disk.
+        Saving moves the network to the CPU and back, which reallocates its parameters, so the training step is captured again afterwards.
+        """
+        BaseModel.save_networks(self, epoch)
+        self.graph = None
+
+    def save_model(self):
+        """Save the model architecture to the disk.
+        Saving moves the network to the CPU and back, which reallocates its parameters, so the training step is captured again afterwards.
+        """
+        BaseModel.save_model(self)
+        self.graph = None
 
     def compute_visuals(self):
         """Calculate additional output images for visualization"""
         
-        # Choose a random sample from the batch
-        idx = randint(0, self.opt.batch_size - 1)
-        
-        # Get the image from thje batch and add an extra 0 dimension for a 4 dimension tensor.
-        self.input_image = self.img[idx]
-        self.input_image = torch.unsqueeze(self.input_image, 0)
+        # Choose a random sample from the batch (the last batch of an epoch may be smaller than batch_size).
+        idx = randint(0, self.img.size(0) - 1)
 
-        # Normailize the masks to [-1:1].
-        self.true_seg = self.seg[idx] * 2 - 1
-        self.true_seg = torch.unsqueeze(self.true_seg, 0)
+        # Slice the sample out of the batch; slicing keeps the 4 dimensions without a copy.
+        self.input_image = self.img[idx:idx + 1]
 
-        self.pred_seg = self.output[idx] * 2 - 1
-        self.pred_seg = torch.unsqueeze(self.pred_seg, 0)
+        # Normailize the masks to [-1:1].
+        self.true_seg = self.seg[idx:idx + 1] * 2 - 1
+        self.pred_seg = torch.sigmoid(self.output[idx:idx + 1]) * 2 - 1
 
     def compute_losses(self):
         """Calculate additional losses for console display and log file"""
-        self.loss_BCE = self.criterionBCE(self.output, self.seg)
-        self.loss_IOU = 1 - self.criterionIOU(self.output, self.seg)
-        self.loss_MSSSIM = self.criterionMSSSIM(self.output, self.seg)
+        pred = torch.sigmoid(self.output.float())
+        self.loss_BCE = self.criterionBCE(self.output.float(), self.seg)
+        self.loss_IOU = 1 - self.criterionIOU(pred, self.seg)
+        self.loss_MSSSIM = self.criterionMSSSIM(pred, self.seg)
@@ -39,6 +39,8 @@ class TrainOptions(BaseOptions):
         parser.add_argument('--pool_size', type=int, default=50, help='the size of image buffer that stores previously generated images')
         parser.add_argument('--lr_policy', type=str, default='linear', help='learning rate policy. [linear | step | plateau | cosine]')
         parser.add_argument('--lr_decay_iters', type=int, default=50, help='multiply by a gamma every lr_decay_iters iterations')
+        parser.add_argument('--profile', action='store_true', help='profile the first training iterations with torch.profiler, and save the trace to [log_dir]/[name]_profile for tensorboard')
+        parser.add_argument('--amp', action='store_true', help='use automatic mixed precision (float16 autocast with gradient scaling) for training on GPU')
         parser.add_argument('--use_val', action='store_true', help='use a validation set to evaluate the validation lose every val_freq epochs')
         parser.add_argument('--val_freq', type=int, default=1, help='frequency of of evaluating validation loss at the end of epochs')
 
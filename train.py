@@ -13,11 +13,14 @@ Example:
         python train.py --dataroot ./datasets/maps --name maps_cyclegan --model cycle_gan
     Train a pix2pix model:
         python train.py --dataroot ./datasets/facades --name facades_pix2pix --model pix2pix --direction BtoA
+    Train a unet model with DistributedDataParallel on 4 GPUs (one process per GPU):
+        torchrun --nproc_per_node=4 train.py --dataroot ./datasets/lits --name lits_unet --model unet
 
 See options/base_options.py and options/train_options.py for more training options.
 See training and test tips at: https://github.com/junyanz/pytorch-CycleGAN-and-pix2pix/blob/master/docs/tips.md
 See frequently asked questions at: https://github.com/junyanz/pytorch-CycleGAN-and-pix2pix/blob/master/docs/qa.md
 """
+import os
 import time
 import torch
 from options.train_options import TrainOptions
@@ -27,6 +30,14 @@ from util.visualizer import Visualizer
 
 if __name__ == '__main__':
     opt = TrainOptions().parse()   # get training options
+    is_main_process = True         # only the first process displays, logs and saves results
+    if 'LOCAL_RANK' in os.environ:  # launched with torchrun: one process per GPU
+        if opt.model != 'unet':
+            raise NotImplementedError('distributed training with torchrun is only supported by the unet model, got [%s]' % opt.model)
+        torch.distributed.init_process_group('nccl')
+        opt.gpu_ids = [int(os.environ['LOCAL_RANK'])]
+        torch.cuda.set_device(opt.gpu_ids[0])
+        is_main_process = torch.distributed.get_rank() == 0
     dataset = create_dataset(opt)  # create a dataset given opt.dataset_mode and other options
     dataset_size = len(dataset)    # get the number of images in the dataset.
     print('The number of training images = %d' % dataset_size)
@@ -40,15 +51,26 @@ if __name__ == '__main__':
 
     model = create_model(opt)      # create a model given opt.model and other options
     model.setup(opt)               # regular setup: load and print networks; create schedulers
-    visualizer = Visualizer(opt)   # create a visualizer that display/save images and plots
+    visualizer = Visualizer(opt) if is_main_process else None   # create a visualizer that display/save images and plots
     total_iters = 0                # the total number of training iterations
+    profiler = None
+    if opt.profile:                # profile the first 5 training iterations: skip 1, warm up on 1 and record 3
+        profiler = torch.profiler.profile(
+            schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(opt.log_dir, opt.name + '_profile')),
+            record_shapes=True,
+            with_stack=True)
+        profiler.start()
+        profile_iters = 5
     best_val_acc = 0
 
     for epoch in range(opt.epoch_count, opt.n_epochs + opt.n_epochs_decay + 1):    # outer loop for different epochs; we save the model by <epoch_count>, <epoch_count>+<save_latest_freq>
         epoch_start_time = time.time()  # timer for entire epoch
         iter_data_time = time.time()    # timer for data loading per iteration
         epoch_iter = 0                  # the number of training iterations in current epoch, reset to 0 every epoch
-        visualizer.reset()              # reset the visualizer: make sure it saves the results to HTML at least once every epoch
+        if is_main_process:
+            visualizer.reset()          # reset the visualizer: make sure it saves the results to HTML at least once every epoch
+        dataset.set_epoch(epoch)        # reshuffle the distributed shards, if any
         for i, data in enumerate(dataset):  # inner loop within one epoch
             iter_start_time = time.time()  # timer for computation per iteration
             if total_iters % opt.print_freq == 0:
@@ -58,13 +80,19 @@ if __name__ == '__main__':
             epoch_iter += opt.batch_size
             model.set_input(data)         # unpack data from dataset and apply preprocessing
             model.optimize_parameters()   # calculate loss functions, get gradients, update network weights
-
-            if total_iters % opt.display_freq == 0:   # display images and save images to a HTML file
+            if profiler is not None:
+                profiler.step()
+                profile_iters -= 1
+                if profile_iters == 0:    # the trace has been saved
+                    profiler.stop()
+                    profiler = None
+
+            if is_main_process and total_iters % opt.display_freq == 0:   # display images and save images to a HTML file
                 save_result = total_iters % opt.update_html_freq == 0
                 model.compute_visuals()
                 visualizer.display_current_results(model.get_current_visuals(), epoch, save_result)
 
-            if total_iters % opt.print_freq == 0:    # print training losses and save logging information to the disk
+            if is_main_process and total_iters % opt.print_freq == 0:    # print training losses and save logging information to the disk
                 losses = model.get_current_losses()
                 t_comp = (time.time() - iter_start_time) / opt.batch_size
                 visualizer.print_current_losses(epoch, epoch_iter, losses, t_comp, t_data)
@@ -104,7 +132,8 @@ if __name__ == '__main__':
             # print validation accuracy
             val_acc = running_corrects.double() / val_set_size
             val_losses = {'val_acc': val_acc}
-            visualizer.print_validation(epoch, val_losses)
+            if is_main_process:
+                visualizer.print_validation(epoch, val_losses)
         
             # save model with the best validation accuracy        
             if val_acc > best_val_acc: